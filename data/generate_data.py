@@ -1,38 +1,116 @@
 #!/usr/bin/env python
 import amqp
+import dataclasses
 import faker
+import logging
+import os
 import random
-import uuid
+import socket
 import time
 
 START = 'start'
 STOP = 'stop'
 
-def generate_customer_data():
+log = logging.getLogger("generate_data")
+
+GUID_POOL_SIZE = 4096
+
+# A dedicated generator instance skips the module level random functions, and can be
+# seeded to make a run reproducible when profiling.
+RANDOM = random.Random()
+
+# Our messages are tiny, so make sure Nagle's algorithm never holds them back waiting to
+# coalesce them. py-amqp sets TCP_NODELAY by default, but we don't want to rely on that.
+SOCKET_SETTINGS = {socket.TCP_NODELAY: 1}
+SEND_BUFFER_SIZE = 1 << 20
+
+@dataclasses.dataclass(frozen=True)
+class CustomerTable:
+    """
+    Customer data stored column-wise. Each customer is an index into the columns, so
+    picking one is a single random number and publishing builds a fresh header dict,
+    instead of mutating a shared one.
+    """
+    region: tuple
+    description: tuple
+    phone: tuple
+    ip_addr: tuple
+
+    def __len__(self):
+        return len(self.phone)
+
+    def headers(self, idx, guid):
+        """ Build the message headers for the customer at this index. """
+        return {
+            "region": self.region[idx],
+            "description": self.description[idx],
+            "phone": self.phone[idx],
+            "ip_addr": self.ip_addr[idx],
+            "guid": guid,
+        }
+
+def generate_customer_data(size=1000):
     """ Generate customer data to use when publishing. """
-    customers = []
-    fake = faker.Faker()
-
-    for idx in range(1000):
-        customers.append({
-            "region": fake.city(),
-            "description": fake.company(),
-            "phone": fake.phone_number(),
-            "ip_addr": fake.ipv4()
-        })
-    return customers
+    # Faker resolves each generator through its providers on every attribute access, so
+    # look them up once. We also don't need realistic weighting for test data.
+    fake = faker.Faker(use_weighting=False)
+    city, company, phone_number, ipv4 = fake.city, fake.company, fake.phone_number, fake.ipv4
+    return CustomerTable(
+        region=tuple(city() for _ in range(size)),
+        description=tuple(company() for _ in range(size)),
+        phone=tuple(phone_number() for _ in range(size)),
+        ip_addr=tuple(ipv4() for _ in range(size)),
+    )
+
+def random_index(size):
+    """
+    Pick a random index below size. We draw only as many random bits as the size needs,
+    and simply draw again on the rare occasion the result is out of range.
+    """
+    bits = (size - 1).bit_length()
+    idx = RANDOM.getrandbits(bits)
+    while idx >= size:
+        idx = RANDOM.getrandbits(bits)
+    return idx
+
+def guid_pool(n=GUID_POOL_SIZE):
+    """
+    Pre-generate a batch of random guids. A single urandom call is sliced into 16 byte
+    chunks, which is much cheaper than building a UUID object for every message.
+    """
+    buf = os.urandom(16 * n)
+    return [buf[i:i + 16].hex() for i in range(0, 16 * n, 16)]
+
+def guids():
+    """ Yield guids forever, refilling the pool whenever it is exhausted. """
+    while True:
+        yield from guid_pool()
+
+# Messages are serialised when they are published, so a single message can be reused for every
+# publish by swapping its headers. The headers live in the message properties; setting the
+# attribute directly would not be sent.
+MESSAGE = amqp.Message(application_headers={})
 
 def publish(channel, headers, key):
-    print(f'{key}: {headers}')
-    msg = amqp.Message(application_headers=headers)
-    channel.basic_publish(msg, exchange="mpi", routing_key=key)
+    # Formatting the headers for every message is expensive, so only do it if we'll log it
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("%s: %s", key, headers)
+    MESSAGE.properties['application_headers'] = headers
+    channel.basic_publish(
+        MESSAGE, exchange="mpi", routing_key=key, mandatory=False, immediate=False)
 
 def run():
     """ Run the main loop. """
     customer_data = generate_customer_data()
+    guid = guids()
     started = []
 
-    with amqp.Connection('rabbitmq:5672') as c:
+    # This is test data, so losing the odd message is fine. Publisher confirms are left off
+    # so we never wait on the broker, and messages that can't be routed are dropped
+    # rather than returned to us.
+    with amqp.Connection(
+            'rabbitmq:5672', confirm_publish=False, socket_settings=SOCKET_SETTINGS) as c:
+        c.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
         ch = c.channel()
         args = {
             "alternate-exchange": "dead-letter"
@@ -46,22 +124,23 @@ def run():
         )
 
         while True:
-            headers = random.choice(customer_data)
-            headers["guid"] = f"{uuid.uuid4()}"
+            idx = random_index(len(customer_data))
+            headers = customer_data.headers(idx, next(guid))
 
             publish(ch, headers, START)
             # append these to our list of started records
             started.append(headers)
 
             # We don't get orders that often.
-            time.sleep(random.randint(1, 20))
+            time.sleep(RANDOM.randint(1, 20))
 
-            stop = random.choice([True, False])
+            stop = RANDOM.getrandbits(1)
             if stop:
                 # randomly choose which stop to publish
-                idx = random.randrange(0, len(started))
+                idx = random_index(len(started))
                 customer = started.pop(idx)
                 publish(ch, customer, STOP)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     run()
\ No newline at end of file
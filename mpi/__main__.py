@@ -1,6 +1,15 @@
 """ Initalise PI. """
+import logging
+
 import yaml
 
+# libyaml's C loader is much faster than the pure Python one, but is only available
+# if PyYAML was built against libyaml.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 import mpi.service
 import mpi.rabbit
 
@@ -16,11 +25,16 @@ def load_config(config_file):
     sufficient for a POC.
     """
     with open(config_file) as f:
-        conf = yaml.safe_load(f)
+        conf = yaml.load(f, Loader=SafeLoader)
     return conf
 
 def main():
     """ Initalise PI. """
+    # logging is configured here rather than on import, so importing the service never
+    # touches the root logger
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     conf = load_config(CONFIG_PATH)
 
     # initialise rabbitmq client
@@ -39,5 +53,7 @@ def main():
         conf['active_time'],
         conf['publish_exchange'],
         conf['publish_key'],
+        # older config files won't have this setting
+        conf.get('prefetch_count', mpi.service.PREFETCH_COUNT),
         )
     pi.run()
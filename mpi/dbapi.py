@@ -1,29 +1,196 @@
 """ SQLite3 API for PI. """
+import json
 import time
 import sqlite3
+import functools
+import itertools
+import contextlib
 
 MEMORY = ':memory:'
 
-def dict_cursor(conn, row):
-    """
-    This method is attached the connection so queries to the cache return us a dictionary. The
-    names of the columns become the dict keys. The SQLite3 default is to return rows as tuples,
-    which is really annoying when named fields are a thing.
-
-    There is also a more efficient way to do this, which returns views of rows using sqlite3.Row,
-    and allows you to access the Row object with dict keys. It does require an extra data transform
-    using dict() if you want to view the actual data. Using this other method is advised for maximum
-    performance or very large data sets.
-
-    :param conn: SQLite3 connection handle
-    :param row: SQLite Row object.
-
-    :returns: a dictionary view of this row, with the column names as keys
-    """
-    d = {}
-    for idx, col in enumerate(conn.description):
-        d[col[0]] = row[idx]
-    return d
+# Every query below is a module level constant, or is built once per batch size, so each one
+# is prepared once and then served from the connection's statement cache, which we size to
+# comfortably hold them all.
+STATEMENT_CACHE_SIZE = 512
+
+# The cache has a single writer and no readers outside this process. An in-memory database
+# always journals in memory and never syncs, but if the cache is ever backed by a file, WAL
+# with synchronous=NORMAL only syncs at checkpoints rather than on every commit.
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA locking_mode=EXCLUSIVE",
+)
+
+_SQL_CREATE_CACHE = """
+CREATE TABLE record (
+    phone TEXT PRIMARY KEY,
+    ip_addr TEXT NOT NULL,
+    region TEXT NOT NULL,
+    guid TEXT NOT NULL,
+    description TEXT NOT NULL,
+    date_created INTEGER NOT NULL,
+    last_active INTEGER NOT NULL,
+    cooldown_expiry INTEGER,
+    tasked_time INTEGER
+)
+"""
+
+# Every cleanup and manifest query filters on cooldown_expiry and/or last_active. Leading with
+# cooldown_expiry serves the cooldown range queries, and for `cooldown_expiry IS NULL` the
+# index entries are already in date_created order, so the manifest is selected without a sort.
+# Including last_active lets the eligibility check be answered from the index alone.
+_SQL_CREATE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_cooldown ON record(cooldown_expiry, date_created, last_active)",
+)
+
+_SQL_SELECT_RECORD = """
+SELECT
+    phone,
+    ip_addr,
+    region,
+    guid,
+    description,
+    last_active,
+    date_created,
+    cooldown_expiry,
+    tasked_time
+FROM record
+WHERE phone=:phone
+"""
+
+_SQL_INSERT_RECORD = """
+INSERT INTO record (
+    phone,
+    ip_addr,
+    region,
+    guid,
+    date_created,
+    last_active,
+    description
+) VALUES (
+    :phone,
+    :ip_addr,
+    :region,
+    :guid,
+    :date_created,
+    :last_active,
+    :description
+)
+"""
+
+# SQLite's default limit on the number of parameters bound to a single statement. Batches of
+# records are inserted with one multi-row VALUES statement per chunk that fits under it.
+MAX_VARIABLES = 999
+
+# Each batched record binds phone, ip_addr, region, guid, description, date_created and
+# last_active, in that order.
+_VALUES_ROW = "(?, ?, ?, ?, ?, ?, ?)"
+_VALUES_CHUNK_SIZE = MAX_VARIABLES // 7
+
+_SQL_INSERT_RECORDS = """
+INSERT INTO record (
+    phone,
+    ip_addr,
+    region,
+    guid,
+    description,
+    date_created,
+    last_active
+) VALUES {values}
+"""
+
+# New customers are inserted, and customers already in the cache have their last_active
+# time refreshed, so a whole batch of starts can be applied at once.
+_SQL_UPSERT_RECORDS = _SQL_INSERT_RECORDS + """\
+ON CONFLICT(phone) DO UPDATE SET last_active=excluded.last_active
+"""
+
+_SQL_DELETE_FINISHED_COOLDOWN = """
+DELETE
+FROM record
+WHERE cooldown_expiry <= :now
+"""
+
+_SQL_DELETE_EXPIRED_RECORDS = """
+DELETE
+FROM record
+WHERE cooldown_expiry IS NULL
+AND last_active <= :now - :active_time
+"""
+
+_SQL_UPDATE_ACTIVE_TIME = """
+UPDATE record
+SET last_active=:last_active
+WHERE phone=:phone
+"""
+
+_SQL_DELETE_RECORD = """
+DELETE FROM
+    record
+WHERE phone=:phone
+AND cooldown_expiry IS NULL
+"""
+
+# The columns of each manifest record, in the order the manifest queries select them.
+MANIFEST_COLUMNS = (
+    'phone',
+    'ip_addr',
+    'region',
+    'guid',
+    'description',
+    'last_active',
+    'date_created',
+    'cooldown_expiry',
+    'tasked_time',
+)
+
+_SQL_SELECT_MANIFEST_RECORDS = """
+SELECT
+    phone,
+    ip_addr,
+    region,
+    guid,
+    description,
+    last_active,
+    date_created,
+    cooldown_expiry,
+    tasked_time
+FROM record
+WHERE cooldown_expiry IS NULL
+AND last_active >= :now - :active_time
+ORDER BY date_created DESC
+LIMIT :limit
+"""
+
+_SQL_COUNT_MANIFEST_RECORDS = """
+SELECT COUNT(*)
+FROM record
+WHERE cooldown_expiry IS NULL
+AND last_active >= :now - :active_time
+"""
+
+# The phone numbers are bound as a single JSON array and expanded by `json_each`, so a manifest
+# of any size is tasked in one statement without running into SQLite's variable limit.
+_SQL_TASK_MANIFEST_RECORDS = """
+UPDATE record
+SET tasked_time = :now
+WHERE phone IN (SELECT value FROM json_each(:phones))
+"""
+
+_SQL_UPDATE_TO_COOLDOWN = """
+UPDATE record
+SET cooldown_expiry = :cooldown_expiry
+WHERE tasked_time IS NOT NULL
+"""
+
+_SQL_UPDATE_FREE_COOLDOWN = """
+UPDATE record
+SET cooldown_expiry = NULL
+WHERE cooldown_expiry IS NOT NULL
+AND last_active > :now - :active_time
+"""
 
 def connect():
     """
@@ -31,34 +198,50 @@ def connect():
 
     :returns: SQLite3 connection handle
     """
-    conn = sqlite3.connect(MEMORY)
-    # set up the dictionary cursor
-    conn.row_factory = dict_cursor
+    conn = sqlite3.connect(MEMORY, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    # sqlite3.Row is implemented in C and lets us access columns by name, without building
+    # a dictionary for every row. Use dict() on a row where a real dictionary is needed.
+    conn.row_factory = sqlite3.Row
     return conn
 
+@contextlib.contextmanager
+def bulk_transaction(conn):
+    """
+    Run a block of statements in one explicit transaction. BEGIN IMMEDIATE takes the write
+    lock up front, so a read followed by an update in the same block always sees the same
+    snapshot, and everything commits together. Any error rolls the whole block back.
+
+    :param conn: SQLite connection handle
+
+    :yields: the same connection, with the transaction open
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        # SQLite ends the transaction itself on some errors, and a ROLLBACK would then fail
+        # and hide the original error
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
 def create_cache(conn):
     """
     Create the table which will be used to store the customer records. SQLite
     stores booleans as integers, and supports UNIX timestamps.
 
-    We mostly generate our own timestamps using `time.time()` instead of using
+    We generate our own timestamps using `time.time()` instead of using
     SQLite's `strftime` because it doesn't include millseconds, which makes it
     impossible to accurately order records inserted or modified in quick succession.
 
     :param conn: SQLite connection handle
     """
-    conn.execute("""
-    CREATE TABLE record (
-        phone TEXT PRIMARY KEY,
-        ip_addr TEXT NOT NULL,
-        region TEXT NOT NULL,
-        guid TEXT NOT NULL,
-        description TEXT NOT NULL,
-        date_created INTEGER NOT NULL,
-        last_active INTEGER NOT NULL,
-        cooldown_expiry INTEGER,
-        tasked_time INTEGER
-    )""")
+    conn.execute(_SQL_CREATE_CACHE)
+    for index in _SQL_CREATE_INDEXES:
+        conn.execute(index)
 
 def select_record(conn, phone):
     """
@@ -69,23 +252,10 @@ def select_record(conn, phone):
 
     :returns: the associated record, or None
     """
-    c = conn.execute("""
-        SELECT
-            phone,
-            ip_addr,
-            region,
-            guid,
-            description,
-            last_active,
-            date_created,
-            cooldown_expiry,
-            tasked_time
-        FROM record
-        WHERE phone=:phone
-    """, {'phone': phone})
+    c = conn.execute(_SQL_SELECT_RECORD, {'phone': phone})
     return c.fetchone()
 
-def insert_record(conn, phone, ip_addr, region, guid, desc):
+def insert_record(conn, phone, ip_addr, region, guid, desc, now=None):
     """
     Insert a record into the cache. Customers are uniquely identified by their
     phone number.
@@ -96,47 +266,98 @@ def insert_record(conn, phone, ip_addr, region, guid, desc):
     :param region: Region this customer is in
     :param guid: the unique identifier for this customer session (BH)
     :param desc: Customer description
+    :param now: timestamp to record the customer at, defaults to the current time
 
     :returns: the number of modified rows
     """
-    c = conn.execute("""
-    INSERT INTO record (
-        phone,
-        ip_addr,
-        region,
-        guid,
-        date_created,
-        last_active,
-        description
-    ) VALUES (
-        :phone,
-        :ip_addr,
-        :region,
-        :guid,
-        :date_created,
-        :last_active,
-        :description
-    )""", {
+    # a single timestamp keeps date_created and last_active identical for new records
+    if now is None:
+        now = time.time()
+    c = conn.execute(_SQL_INSERT_RECORD, {
         'phone': phone, 'ip_addr': ip_addr, 'region': region, 'guid': guid,
-        'date_created': time.time(), 'last_active': time.time(), 'description': desc
+        'date_created': now, 'last_active': now, 'description': desc
     })
     return c.rowcount
 
-def delete_finished_cooldown(conn):
+@functools.lru_cache(maxsize=None)
+def _values_sql(sql, rows):
+    """
+    Fill in the VALUES placeholders of an insert statement for the given number of rows. There
+    is at most one statement per chunk size for each insert, so they are memoised rather than
+    joined and formatted on every call. sqlite3's statement cache matches on the SQL text, so
+    this saves building the string, not preparing the statement.
+
+    :param sql: insert statement, with a `{values}` placeholder for the rows
+    :param rows: number of rows to insert
+
+    :returns: the insert statement
+    """
+    return sql.format(values=", ".join([_VALUES_ROW] * rows))
+
+def _insert_values(conn, sql, records, now):
+    """
+    Insert records in chunks, with one multi-row VALUES statement per chunk.
+
+    :param conn: SQLite connection handle
+    :param sql: insert statement, with a `{values}` placeholder for the rows
+    :param records: (phone, ip_addr, region, guid, description) tuples
+    :param now: timestamp to record the batch at
+
+    :returns: the number of modified rows
+    """
+    count = 0
+    for start in range(0, len(records), _VALUES_CHUNK_SIZE):
+        chunk = records[start:start + _VALUES_CHUNK_SIZE]
+        params = list(itertools.chain.from_iterable(record + (now, now) for record in chunk))
+        count += conn.execute(_values_sql(sql, len(chunk)), params).rowcount
+    return count
+
+def insert_records(conn, records, now=None):
+    """
+    Insert a batch of new customers into the cache. Like `insert_record`, this fails if any
+    of the customers are already in the cache. Every record in the batch shares the same
+    timestamp.
+
+    :param conn: SQLite connection handle
+    :param records: (phone, ip_addr, region, guid, description) tuples
+    :param now: timestamp to record the batch at, defaults to the current time
+
+    :returns: the number of modified rows
+    """
+    if now is None:
+        now = time.time()
+    return _insert_values(conn, _SQL_INSERT_RECORDS, records, now)
+
+def upsert_records_many(conn, records, now=None):
+    """
+    Insert a batch of customers into the cache. Customers who are already in the cache only
+    have their last_active time updated, the same as `update_active_time`. Every record in
+    the batch shares the same timestamp.
+
+    :param conn: SQLite connection handle
+    :param records: (phone, ip_addr, region, guid, description) tuples
+    :param now: timestamp to record the batch at, defaults to the current time
+
+    :returns: the number of modified rows
+    """
+    if now is None:
+        now = time.time()
+    return _insert_values(conn, _SQL_UPSERT_RECORDS, records, now)
+
+def delete_finished_cooldown(conn, now=None):
     """
     Delete records who have completed their cooldown time.
 
     :param conn: SQLite connection handle
+    :param now: the current time, defaults to `time.time()`
     :returns: the amount of rows which were deleted
     """
-    c = conn.execute("""
-        DELETE
-        FROM record
-        WHERE cooldown_expiry <= :now
-    """, {'now': time.time()})
+    if now is None:
+        now = time.time()
+    c = conn.execute(_SQL_DELETE_FINISHED_COOLDOWN, {'now': now})
     return c.rowcount
 
-def delete_expired_records(conn, active_time):
+def delete_expired_records(conn, active_time, now=None):
     """
     Delete records which are past their expiry time, and are not in cooldown.
 
@@ -146,14 +367,12 @@ def delete_expired_records(conn, active_time):
 
     :param conn: SQLite connection handle
     :param active_time: the amount of time records are active after they were last updated
+    :param now: the current time, defaults to `time.time()`
     :returns: the amount of rows which were deleted
     """
-    c = conn.execute("""
-        DELETE
-        FROM record
-        WHERE cooldown_expiry IS NULL
-        AND (last_active + :active_time) <= :now
-    """, {'active_time': active_time, 'now': time.time()})
+    if now is None:
+        now = time.time()
+    c = conn.execute(_SQL_DELETE_EXPIRED_RECORDS, {'active_time': active_time, 'now': now})
     return c.rowcount
 
 def update_active_time(conn, phone):
@@ -161,11 +380,7 @@ def update_active_time(conn, phone):
     Update the active time on a record. This occurs when a customer already in the cache
     gets a new start message.
     """
-    conn.execute("""
-        UPDATE record
-        SET last_active=:last_active
-        WHERE phone=:phone
-    """, {'phone': phone, 'last_active': time.time()})
+    conn.execute(_SQL_UPDATE_ACTIVE_TIME, {'phone': phone, 'last_active': time.time()})
 
 def delete_record(conn, phone):
     """
@@ -178,58 +393,89 @@ def delete_record(conn, phone):
 
     :returns: the count of the rows modified
     """
-    c = conn.execute("""
-        DELETE FROM
-            record
-        WHERE phone=:phone
-        AND cooldown_expiry IS NULL
-    """, {'phone': phone})
+    c = conn.execute(_SQL_DELETE_RECORD, {'phone': phone})
     return c.rowcount
 
-def select_manifest_records(conn, active_time):
+def delete_records_many(conn, phones):
+    """
+    Delete a batch of customers from the cache, skipping any who are in cooldown, the same
+    as `delete_record`.
+
+    :param conn: SQLite connection handle
+    :param phones: the customers phone numbers
+
+    :returns: the number of records deleted for each phone number, in the same order. A 0 means
+        the customer wasn't in the cache, is in cooldown, or was already deleted by this batch
+    """
+    # each delete reuses the same prepared statement
+    return [conn.execute(_SQL_DELETE_RECORD, {'phone': phone}).rowcount for phone in phones]
+
+def select_manifest_records(conn, active_time, limit=None, now=None):
     """
     Select all the records which are eligible to be included in a manifest.
 
     :param conn: SQLite connection handle
     :param active_time: seconds records are considered active for, after they were last updated
+    :param limit: maximum number of records to select, or None to select them all
+    :param now: the current time, defaults to `time.time()`
+
+    :returns: a cursor which yields the eligible rows, newest first
+    """
+    if now is None:
+        now = time.time()
+    # SQLite treats a negative LIMIT as no limit, so one statement covers both cases
+    return conn.execute(_SQL_SELECT_MANIFEST_RECORDS, {
+        'active_time': active_time,
+        'now': now,
+        'limit': -1 if limit is None else limit})
+
+def task_manifest_columns(conn, active_time, limit=None, now=None):
+    """
+    Fetch the records which are eligible to be included in a manifest one column at a time,
+    and mark them as tasked. Rows are fetched as plain tuples and transposed, so no per-row
+    mapping is ever built. The phone numbers selected are bound into the tasking UPDATE, so
+    the records tasked are exactly the ones returned.
 
-    :returns: a list of dictionaries, or an empty list
-    """
-    c = conn.execute("""
-        SELECT
-            phone,
-            ip_addr,
-            region,
-            guid,
-            description,
-            last_active,
-            date_created,
-            cooldown_expiry,
-            tasked_time
-        FROM record
-        WHERE cooldown_expiry IS NULL
-        AND (last_active + :active_time) >= :now
-        ORDER BY date_created DESC
-    """, {'active_time': active_time, 'now': time.time()})
-    return c.fetchall()
-
-def update_to_tasked(conn, records):
-    """
-    Mark all these records as tasked so we can keep track of which records have been published.
-    This is the only function where we use the SQLite strftime, because tasked_time is never
-    compared between records, and is mostly used as a boolean test. Decided to store it as a
-    timestamp only for potentially easier debugging so it doesn't matter there's no milliseconds.
+    The records are the newest first, the same as `select_manifest_records`, and their
+    `tasked_time` is the one they had before this manifest.
 
     :param conn: SQLite connection handle
-    :param records: a list of dictionaries with customer datas
+    :param active_time: seconds records are considered active for, after they were last updated
+    :param limit: maximum number of records to task, or None to task them all
+    :param now: the current time, defaults to `time.time()`
+
+    :returns: a dict of each name in MANIFEST_COLUMNS to a tuple of its values
+    """
+    if now is None:
+        now = time.time()
+    c = conn.cursor()
+    c.row_factory = None
+    c.execute(_SQL_SELECT_MANIFEST_RECORDS, {
+        'active_time': active_time,
+        'now': now,
+        'limit': -1 if limit is None else limit})
+    columns = dict(zip(MANIFEST_COLUMNS, tuple(zip(*c)) or ((),) * len(MANIFEST_COLUMNS)))
+    conn.execute(_SQL_TASK_MANIFEST_RECORDS, {
+        'phones': json.dumps(columns['phone']),
+        'now': now})
+    return columns
+
+def count_manifest_records(conn, active_time, now=None):
     """
-    conn.executemany("""
-        UPDATE record
-        SET tasked_time = strftime('%s','now')
-        WHERE phone = :phone
-    """, records)
+    Count the records which are eligible to be included in a manifest, without fetching them.
 
-def update_to_cooldown(conn, cooldown_time):
+    :param conn: SQLite connection handle
+    :param active_time: seconds records are considered active for, after they were last updated
+    :param now: the current time, defaults to `time.time()`
+
+    :returns: the number of eligible records
+    """
+    if now is None:
+        now = time.time()
+    c = conn.execute(_SQL_COUNT_MANIFEST_RECORDS, {'active_time': active_time, 'now': now})
+    return c.fetchone()[0]
+
+def update_to_cooldown(conn, cooldown_time, now=None):
     """
     Update all the records which have a tasked_time, and send them to cooldown. Cooldown means they
     cannot be included as part of a manifest, and expires when the cooldown time has elapsed, or they
@@ -237,24 +483,24 @@ def update_to_cooldown(conn, cooldown_time):
 
     :param conn: SQLite connection handle
     :param cooldown_time: seconds customer records must remain in cooldown
+    :param now: the current time, defaults to `time.time()`
     """
-    conn.execute("""
-        UPDATE record
-        SET cooldown_expiry = :cooldown_expiry
-        WHERE tasked_time IS NOT NULL
-    """, {'cooldown_expiry': time.time() + cooldown_time})
+    if now is None:
+        now = time.time()
+    conn.execute(_SQL_UPDATE_TO_COOLDOWN, {'cooldown_expiry': now + cooldown_time})
 
-def update_free_cooldown(conn, active_time):
+def update_free_cooldown(conn, active_time, now=None):
     """
     Free customers from cooldown if they have a `cooldown_expiry` set and their active
     window (`last_active` + active_time) is later than now.
 
     :param conn: SQLite connection handle
     :param active_time: seconds records are considered active for, after they were last updated
+    :param now: the current time, defaults to `time.time()`
+
+    :returns: the number of records freed from cooldown
     """
-    conn.execute("""
-        UPDATE record
-        SET cooldown_expiry = NULL
-        WHERE cooldown_expiry IS NOT NULL
-        AND last_active + :active_time > :now
-    """, {'active_time': active_time, 'now': time.time()})
\ No newline at end of file
+    if now is None:
+        now = time.time()
+    c = conn.execute(_SQL_UPDATE_FREE_COOLDOWN, {'active_time': active_time, 'now': now})
+    return c.rowcount
\ No newline at end of file
@@ -0,0 +1,38 @@
+""" Parses the customer metadata carried in RabbitMQ message headers. """
+import typing
+
+class HeaderError(Exception):
+    """ Raised when a message's headers are missing some of the customer metadata. """
+
+class Headers(typing.NamedTuple):
+    """
+    Customer metadata from a start or stop message. The fields are in the order the cache
+    inserts them, so a parsed start can be buffered and inserted as it is.
+    """
+    phone: str
+    ip_addr: str
+    region: str
+    guid: str
+    description: str
+
+def parse(application_headers):
+    """
+    Pull the customer metadata out of a message's headers, once, at ingress.
+
+    :param application_headers: RabbitMQ message headers
+
+    :returns: the parsed Headers
+    :raises HeaderError: if any of the expected headers are missing
+    """
+    try:
+        return Headers(
+            application_headers['phone'],
+            application_headers['ip_address'],
+            application_headers['region'],
+            application_headers['guid'],
+            # We've been bitten by empty descriptions in the past
+            application_headers['description'] or 'UNKNOWN')
+    except KeyError as exp:
+        raise HeaderError(
+            f'Message headers were improperly formed {application_headers}, KeyError: {exp}'
+        ) from exp
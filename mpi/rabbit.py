@@ -2,15 +2,25 @@
 These methods are mostly replaced or implemented by mrabbit.
 """
 import amqp
+import time
+import heapq
+import socket
 import logging
-import datetime
+import selectors
+import itertools
 
-# Having this set to 1 second is easiest for development as it
-# makes the logs easier to follow, and is more than low enough to
-# ensure we publish on time. In production, this value could be
-# below 1 second.
+# How long to wait for messages when there are no timers to schedule
+# around. When timers are set, we only wait until the next one is due.
 TIMEOUT = 1
 
+# The most frames handled on each wake up before the timers are checked again. A queue with a
+# backlog keeps the socket readable, as the broker tops up the prefetch window after every ack.
+MAX_FRAMES_PER_WAKE = 256
+
+# How long a read may wait for the rest of a frame which arrived split across segments. A
+# zero timeout makes py-amqp spin on the socket until the rest arrives.
+DRAIN_TIMEOUT = 0.001
+
 class Timer:
     """ Defines a timer. """
     def __init__(self, name, interval, method):
@@ -22,23 +32,24 @@ class Timer:
         :param method: the function to call when this timer expires
         """
         self.name = name
-        self.interval = datetime.timedelta(seconds=interval)
-        self.last_run = datetime.datetime.now()
+        self.interval = interval
+        # monotonic time is cheap to read and compare, and is not affected by clock changes
+        self.due = time.monotonic() + interval
         self.method = method
 
     def run(self):
         """
         Checks if the timer is due, and if it is, calls the method belonging to the
-        timer, and updates the last_run time. Errors raised by the timer method are
+        timer, and schedules the next run. Errors raised by the timer method are
         raised and should be handled by the client.
         """
         # we could also set a window here, so if we're within range of the timer,
         # just run it. This could be proportional to the interval to ensure it scales
         # nicely.
-        timer_due = self.last_run + self.interval
-        if timer_due <= datetime.datetime.now():
+        now = time.monotonic()
+        if now >= self.due:
             self.method()
-            self.last_run = datetime.datetime.now()
+            self.due = now + self.interval
 
 class Rabbit:
     """ Replaces mrabbit main class. """
@@ -63,6 +74,11 @@ class Rabbit:
         # to track the internal state of magicrabbit, allowing us to manage
         # publishing mux data, and set a max duration for consume.
         self.timers = {}
+        # Timers are also kept in a heap ordered by when they are next due, so
+        # we only ever need to look at the front of the heap to find due timers.
+        # The sequence number breaks ties between timers due at the same time.
+        self._heap = []
+        self._sequence = itertools.count()
 
     def _connect(self):
         """ Create a connection to RabbitMQ. """
@@ -145,27 +161,55 @@ class Rabbit:
             queue=self.consumer_bindings['input_queue'],
             callback=callback)
 
-        while True:
-            try:
-                # This connection times out after the configured time, allowing us to
-                # exit the blocking loop and do something else.
-                self.conn.drain_events(TIMEOUT)
-            except OSError:
-                # We catch the OSError/socket.timeout so we can check the timers,
-                # before continuing.
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.conn.sock, selectors.EVENT_READ)
+            while True:
+                # Sleep until there is something to read, or the next timer is due. When we
+                # are idle, this wakes up for the timers without raising a socket timeout.
+                if selector.select(self._time_until_next_timer()):
+                    self._drain_ready_events()
+                # Checking the timers is cheap when none are due, so we do it after every
+                # wake up, so a busy queue can't hold up the timers.
                 self.check_timers()
 
+    def _drain_ready_events(self):
+        """
+        Handle what is ready to be read from the connection. py-amqp buffers what it reads from
+        the socket, so we keep draining until it would block, rather than going back to the
+        selector with messages still in the buffer. We stop early once a timer is due, or after
+        MAX_FRAMES_PER_WAKE frames, so the timers still run while the queue has a backlog.
+        """
+        try:
+            for _ in range(MAX_FRAMES_PER_WAKE):
+                self.conn.drain_events(DRAIN_TIMEOUT)
+                if not self._time_until_next_timer():
+                    break
+        except socket.timeout:
+            pass
+
+    def _time_until_next_timer(self):
+        """ Seconds until the next timer is due, or the default timeout if there are none. """
+        if not self._heap:
+            return TIMEOUT
+        return max(0, self._heap[0][0] - time.monotonic())
+
     def check_timers(self):
         """
-        This functions runs all the timers. The Timer class will only run the attached timer
-        method if the timer is due.
+        This functions runs all the timers which are due. Each timer that runs is pushed back
+        onto the heap with its next due time.
         """
-        # we use list around the items(), to create a shallow, view copy of the timer dict,
-        # and iterate over that instead of the dict itself. Due to the way the timers are
-        # called, its possible we could be deleting a timer at the same time we were iterating
-        # over this dict, causing it to change size, and resulting in a RuntimeError.
-        for name, timer in list(self.timers.items()):
+        now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+
+        for timer in due:
+            # Timers which were deleted or replaced after they were scheduled are dropped.
+            # This also makes it safe for a timer method to add or delete timers.
+            if self.timers.get(timer.name) is not timer:
+                continue
             timer.run()
+            heapq.heappush(self._heap, (timer.due, next(self._sequence), timer))
 
     def add_timer(self, name, interval, method):
         """
@@ -176,8 +220,10 @@ class Rabbit:
         :param interval: number of seconds this timer runs for, before calling the function
         :param method: the function to call when this timer expires
         """
-        self.timers[name] = Timer(name, interval, method)
-        self.logger.info(f'Added new timer {name}.')
+        timer = Timer(name, interval, method)
+        self.timers[name] = timer
+        heapq.heappush(self._heap, (timer.due, next(self._sequence), timer))
+        self.logger.info('Added new timer %s.', name)
 
     def delete_timer(self, name):
         """
@@ -187,9 +233,10 @@ class Rabbit:
 
         :param name: name of the timer instance to remove.
         """
-        if name in self.timers.keys():
-            timer = self.timers.pop(name)
-            self.logger.info(f'Deleted tracked timer {name}: {timer}')
+        timer = self.timers.pop(name, None)
+        if timer is not None:
+            # any entry left in the heap for this timer is dropped when it is next due
+            self.logger.info('Deleted tracked timer %s: %s', name, timer)
 
     def reject_message(self, error_log, delivery_tag):
         """
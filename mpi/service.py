@@ -1,22 +1,84 @@
 """ Initalises the service class and storage cache. """
-import json
+import time
 import logging
 import datetime
+import itertools
+
+import orjson
 
 import mpi.dbapi as dbapi
+import mpi.headers
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 START = 'start'
 STOP = 'stop'
 TIMER = 'pi_manifest'
+DRAIN_TIMER = 'pi_drain'
+
+# Messages are buffered and applied to the cache in batches, each in a single transaction,
+# followed by a single multiple=True ack. A batch is drained once it reaches BATCH_SIZE
+# messages, and a timer drains any partial batch every DRAIN_INTERVAL seconds.
+BATCH_SIZE = 100
+DRAIN_INTERVAL = 0.05
+
+# How many unacknowledged messages RabbitMQ will send us before waiting for acks.
+PREFETCH_COUNT = 256
+
+def _make_packer(names):
+    """
+    Build a function which packs one value per column into a record dict. The manifest columns
+    never change, so the keys are written into the function's source once, instead of being
+    zipped with every record.
+
+    :param names: column names, in the order their values are passed in
+    :returns: function taking one positional argument per column, and returning a dict
+    """
+    args = ', '.join(f'c{i}' for i in range(len(names)))
+    items = ', '.join(f'{name!r}: c{i}' for i, name in enumerate(names))
+    namespace = {}
+    exec(f'def pack({args}):\n    return {{{items}}}\n', namespace)
+    return namespace['pack']
+
+_pack_record = _make_packer(dbapi.MANIFEST_COLUMNS)
+
+def _route_start(pi, headers):
+    """ Hand a parsed start message to `Pi.on_start`. """
+    pi.on_start(headers)
+
+def _route_stop(pi, headers):
+    """ Hand a parsed stop message to `Pi.on_stop`, which only needs the phone number. """
+    pi.on_stop(headers.phone)
+
+# Handlers for each routing key we consume. Looking the key up here both validates it and
+# picks the handler, so each message costs a single dict lookup.
+_ROUTES = {
+    START: _route_start,
+    STOP: _route_stop,
+}
 
 class Pi:
+    # Attributes are read on every message, and slots make those lookups a fixed offset
+    # rather than an instance dict lookup.
+    __slots__ = (
+        'rabbit',
+        'refresh_time',
+        'manifest_size',
+        'cooldown_time',
+        'active_time',
+        'publish_exchange',
+        'publish_key',
+        'logger',
+        'conn',
+        '_reject',
+        '_buffer',
+        '_pending_tags',
+        'prefetch_count',
+        'batch_size',
+    )
+
     def __init__(
                 self, rabbit, refresh_time, manifest_size, cooldown_time, active_time,
-                publish_exchange, publish_key):
+                publish_exchange, publish_key, prefetch_count=PREFETCH_COUNT):
         """
         Initialise and configure the instance.
 
@@ -27,8 +89,11 @@ class Pi:
         :param expiry_time: how many seconds each start is valid for
         :param publish_exchange: exchange for published MPI data
         :param publish_key: routing key used to publish manifests
+        :param prefetch_count: maximum unacknowledged messages RabbitMQ will deliver to us
         """
         self.rabbit = rabbit
+        # bound once, rather than walking self.rabbit for each rejected message
+        self._reject = rabbit.reject_message
 
         self.refresh_time = refresh_time
         self.manifest_size = manifest_size
@@ -41,6 +106,15 @@ class Pi:
         self.logger = logging.getLogger("PI")
         self.conn = dbapi.connect()
 
+        # starts and stops waiting to be applied to the cache, in the order they arrived
+        self._buffer = []
+        # delivery tags of buffered messages which haven't been acknowledged yet
+        self._pending_tags = []
+        # We must drain and ack before the prefetch window fills up, otherwise RabbitMQ stops
+        # delivering and we sit idle until the drain timer fires.
+        self.prefetch_count = prefetch_count
+        self.batch_size = min(BATCH_SIZE, prefetch_count)
+
     def run(self):
         """ Connect to RabbitMQ and set timers. """
         self.logger.info("Starting up PI")
@@ -49,10 +123,14 @@ class Pi:
             dbapi.create_cache(self.conn)
 
             self.rabbit.init_consumer()
+            # Let RabbitMQ keep a window of messages in flight to us, instead of waiting for
+            # each one to be acked before delivering the next.
+            self.rabbit.consume_channel.basic_qos(0, self.prefetch_count, False)
             self.rabbit.init_publisher(self.publish_exchange)
             # Add a timer to our RabbitMQ consumer. Whenever the timer expires,
             # the method passed into this function will be called.
             self.rabbit.add_timer(TIMER, self.refresh_time, self.publish_manifest)
+            self.rabbit.add_timer(DRAIN_TIMER, DRAIN_INTERVAL, self.drain)
             self.rabbit.consume(self.message_callback)
         finally:
             self.stop()
@@ -61,8 +139,15 @@ class Pi:
         """ Shut down PI. """
         self.logger.info("Stopping PI")
         self.rabbit.delete_timer(TIMER)
-        self.rabbit.stop()
-        self.conn.close()
+        self.rabbit.delete_timer(DRAIN_TIMER)
+        try:
+            # finish off anything we've already received, and let RabbitMQ know before we go.
+            # If we're stopping because a drain failed, this fails the same way, but we must
+            # still close our connections.
+            self.drain()
+        finally:
+            self.rabbit.stop()
+            self.conn.close()
 
     def message_callback(self, message):
         """
@@ -77,101 +162,125 @@ class Pi:
 
         NOTE: We might have to think about what that would mean if it happened repeatedly.
         """
-        headers = message.application_headers
         routing_key = message.delivery_info['routing_key']
         tag = message.delivery_tag
 
         # we can only process start or stop beyond this point, so reject other messages
-        if routing_key not in [START, STOP]:
-            self.rabbit.reject_message(
+        route = _ROUTES.get(routing_key)
+        if route is None:
+            self._reject(
                 f"Message has unexpected routing key '{routing_key}', rejecting message", tag)
             return
 
         try:
-            phone = headers['phone']
-            ip_addr = headers['ip_address']
-            # We've been bitten by empty descriptions in the past
-            desc = headers['description'] or 'UNKNOWN'
-            region = headers['region']
-            guid = headers['guid']
-        except KeyError as exp:
+            headers = mpi.headers.parse(message.application_headers)
+        except mpi.headers.HeaderError as exp:
             # If this message has bad headers, reject it and carry on
-            self.rabbit.reject_message(
-                f'Message headers were improperly formed {headers}, KeyError: {exp}', tag)
+            self._reject(str(exp), tag)
             return
 
-        if routing_key == START:
-            self.on_start(phone, ip_addr, desc, region, guid)
-            self.rabbit.consume_channel.basic_ack(tag)
-            return
+        route(self, headers)
 
-        if routing_key == STOP:
-            self.on_stop(phone)
-            self.rabbit.consume_channel.basic_ack(tag)
+        self._pending_tags.append(tag)
+        self._maybe_drain()
+
+    def _maybe_drain(self):
+        """ Drain the buffered messages once we have a full batch. """
+        if len(self._pending_tags) >= self.batch_size:
+            self.drain()
+
+    def flush_acks(self):
+        """
+        Acknowledge every pending message with a single ack. Delivery tags increase on a channel,
+        so acking the latest tag with `multiple` set covers all the earlier ones too. Messages we
+        rejected have already been settled, so they aren't affected.
+        """
+        if not self._pending_tags:
             return
+        self.rabbit.consume_channel.basic_ack(delivery_tag=self._pending_tags[-1], multiple=True)
+        self._pending_tags.clear()
 
     def publish_manifest(self):
         """
         This method exports and publishes the current manifest. This function is
         called by a timer instance attached to MRabbit.
         """
-        manifest = self.generate_manifest()
-        data = json.dumps(manifest, indent=2)
+        # make sure the cache is up to date with everything we've received
+        self.drain()
+        columns = self.generate_manifest()
+        # the records are only packed into one object each here, for the payload
+        manifest = list(map(_pack_record, *columns.values()))
+        record_count = len(manifest)
+        # orjson encodes straight to compact bytes, which go on the wire as they are
+        data = orjson.dumps(manifest)
         headers = {
             'source': 'mpi',
-            'published_at': datetime.datetime.isoformat(datetime.datetime.now()),
-            'records': len(manifest)}
+            'published_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'records': record_count}
         self.rabbit.publish(self.publish_exchange, headers, data, self.publish_key)
-        self.logger.info(f'Published manifest with {len(manifest)} records.')
+        self.logger.info('Published manifest with %s records.', record_count)
 
     def generate_manifest(self):
-        """ Generates the manifest to be published. """
-        # prune cache by removing records who are past their allowed active time, or who
-        # have completed their cooldown
-        self._prune_cache()
-
-        # Check whether we need to enforce cooldown due to an oversized cache, or free some
-        # customers from cooldown if the cache is undersized.
-        self._send_to_cooldown()
-
-        # If we still have too many active records, we trim the list. The records are ordered
-        # from most recent date_created, so we select from the beginning of the list to the
-        # record max. This is because we assume the newest records are the most valuable, and
-        # the old ones may be near to expiry.
-
-        # We use date_created instead of last_active to avoid a situation where a customer
-        # we regular receive starts for always appears to be new. Using last_active for
-        # cooldown and expiry, and date_created for trimming the manifest, is the most
-        # optimised way to keep the manifest as full as possible.
-        with self.conn as conn:
-            records = dbapi.select_manifest_records(conn, self.active_time)
-            if len(records) > self.manifest_size:
-                over_count = len(records) - self.manifest_size
+        """
+        Generates the manifest to be published. Every step runs in a single transaction, so the
+        whole manifest is built from one consistent view of the cache, and committed once.
+        """
+        # Every step judges expiry, cooldown and activity against the same moment, so the counts
+        # and the records picked for the manifest always agree with each other.
+        now = time.time()
+        with dbapi.bulk_transaction(self.conn) as conn:
+            # prune cache by removing records who are past their allowed active time, or who
+            # have completed their cooldown
+            self._prune_cache(conn, now)
+
+            # Check whether we need to enforce cooldown due to an oversized cache, or free some
+            # customers from cooldown if the cache is undersized.
+            eligible_count = self._send_to_cooldown(conn, now)
+
+            # If we still have too many active records, we trim the list. The records are ordered
+            # from most recent date_created, so we select from the beginning of the list to the
+            # record max. This is because we assume the newest records are the most valuable, and
+            # the old ones may be near to expiry.
+
+            # We use date_created instead of last_active to avoid a situation where a customer
+            # we regular receive starts for always appears to be new. Using last_active for
+            # cooldown and expiry, and date_created for trimming the manifest, is the most
+            # optimised way to keep the manifest as full as possible.
+
+            # SQLite stops producing rows once the manifest is full, so we only ever fetch the
+            # records that make it into the manifest, and then mark those as tasked in the same
+            # transaction. If these have been previously tasked, the manifest carries their
+            # previous `tasked_time`, and the stored one is overwritten.
+
+            # We already know how many are eligible from `_send_to_cooldown`, so the rest are
+            # never read.
+            columns = dbapi.task_manifest_columns(
+                conn, self.active_time, limit=self.manifest_size, now=now)
+            over_count = eligible_count - len(columns['phone'])
+            if over_count > 0:
                 self.logger.warning(
-                    f'Cache is still oversized after pruning and enforcing cooldown. '
-                    f'Ignoring {over_count} oldest records.')
+                    'Cache is still oversized after pruning and enforcing cooldown. '
+                    'Ignoring %s oldest records.', over_count)
                 # We don't need to do anything with the excluded records, as they will either
                 # be expired or sent to cooldown next time this is run
-                records = records[:self.manifest_size]
 
-            # mark all these records as being being tasked. If these have been previously tasked,
-            # the `tasked_time` will be overwritten.
-            dbapi.update_to_tasked(conn, records)
-            return records
+            return columns
 
-    def _prune_cache(self):
+    def _prune_cache(self, conn, now):
         """
         We can prune the cache by deleting records which are past the allowed active window,
         or customers who have completed their cooldown.
+
+        :param conn: SQLite connection handle, with the manifest transaction open
+        :param now: the time the manifest is being generated at
         """
-        with self.conn as conn:
-            expired = dbapi.delete_expired_records(conn, self.active_time)
-            self.logger.debug(f'Pruned {expired} expired records from the cache.')
+        expired = dbapi.delete_expired_records(conn, self.active_time, now)
+        self.logger.debug('Pruned %s expired records from the cache.', expired)
 
-            cooldown_finished = dbapi.delete_finished_cooldown(conn)
-            self.logger.debug(f'Pruned {cooldown_finished} records who have completed cooldown.')
+        cooldown_finished = dbapi.delete_finished_cooldown(conn, now)
+        self.logger.debug('Pruned %s records who have completed cooldown.', cooldown_finished)
 
-    def _send_to_cooldown(self):
+    def _send_to_cooldown(self, conn, now):
         """
         By counting the amount of records which are NOT in cooldown and NOT expired, we can
         ascertain the total number of eligible records in the cache. If we are below the
@@ -181,68 +290,92 @@ class Pi:
         This method first prunes an oversized cache by sending all previously tasked customers
         to cooldown, and then attempts to recover if the cache is undersize, by freeing recently
         active customers from cooldown.
+
+        :param conn: SQLite connection handle, with the manifest transaction open
+        :param now: the time the manifest is being generated at
+
+        :returns: the number of eligible records left in the cache
+        """
+        eligible_count = dbapi.count_manifest_records(conn, self.active_time, now)
+        if eligible_count > self.manifest_size:
+            self.logger.info('Cache is oversized. Sending customers to cooldown.')
+            # There is potential optimisations to be had here. Currently this could
+            # result in 90% of the cache being sent to cooldown. We could cooldown
+            # only the amount of records we need to drop below the manifest size,
+            # but these rules would be fairly arbitrary, so instead we just force them
+            # all into cooldown and release them if we have space AND we have received
+            # a start for them within the active window.
+            dbapi.update_to_cooldown(conn, self.cooldown_time, now)
+
+            # We recount the records again, because the eligible records have now changed
+            # and we want to re-fill the cache if we were too heavy-handed with cooldown.
+            # If nothing was sent to cooldown, the first count still stands.
+            eligible_count = dbapi.count_manifest_records(conn, self.active_time, now)
+
+        if eligible_count < self.manifest_size:
+            # Because we keep track of the `last_active` time for customers in the cache,
+            # we can tell which, if any, are currently active but in enforced cooldown.
+            # If our cache is below the allowed size, we can free these customers from
+            # cooldown in order to fill more slots. We don't really care if we free too
+            # many because we might just ignore a few of the oldest ones if we're still
+            # over size.
+            self.logger.debug(
+                'Cache undersized. Freeing any recently seen customers from cooldown.')
+            # Every freed customer is active and out of cooldown, so they are all eligible.
+            eligible_count += dbapi.update_free_cooldown(conn, self.active_time, now)
+
+        return eligible_count
+
+    def on_start(self, headers):
         """
-        with self.conn as conn:
-            eligible_records = dbapi.select_manifest_records(conn, self.active_time)
-            if len(eligible_records) > self.manifest_size:
-                self.logger.info(f'Cache is oversized. Sending customers to cooldown.')
-                # There is potential optimisations to be had here. Currently this could
-                # result in 90% of the cache being sent to cooldown. We could cooldown
-                # only the amount of records we need to drop below the manifest size,
-                # but these rules would be fairly arbitrary, so instead we just force them
-                # all into cooldown and release them if we have space AND we have received
-                # a start for them within the active window.
-                dbapi.update_to_cooldown(conn, self.cooldown_time)
-
-            # We reselect the records again, because if we hit the previous conditional,
-            # the eligible records have now changed and we want to run this to re-fill
-            # the cache if we were too heavy-handed with cooldown.
-            eligible_records = dbapi.select_manifest_records(conn, self.active_time)
-            if len(eligible_records) < self.manifest_size:
-                # Because we keep track of the `last_active` time for customers in the cache,
-                # we can tell which, if any, are currently active but in enforced cooldown.
-                # If our cache is below the allowed size, we can free these customers from
-                # cooldown in order to fill more slots. We don't really care if we free too
-                # many because we might just ignore a few of the oldest ones if we're still
-                # over size.
-                self.logger.debug(
-                    f'Cache undersized. Freeing any recently seen customers from cooldown.')
-                dbapi.update_free_cooldown(conn, self.active_time)
-
-    def on_start(self, phone, ip_addr, region, desc, guid):
-        """
-        Called when a message is received with a `start` routing key.
-
-        :param phone: Customer's phone number.
-        :param ip_addr: Customer's IP address
-        :param region: Region this customer is in
-        :param guid: the unique identifier for this customer session (BH)
-        :param desc: Customer description
-        """
-        with self.conn as conn:
-            record = dbapi.select_record(conn, phone)
-            # if the customer is not already in the cache, we need to add them
-            if record is None:
-                self.logger.info(f'Inserted new record for customer phone={phone}')
-                dbapi.insert_record(conn, phone, ip_addr, region, guid, desc)
-                return
-
-            # if they are, we just want to update their last_active time.
-            self.logger.info(f'New start for customer in cache. Updated last_active for phone={phone}')
-            dbapi.update_active_time(conn, phone)
+        Called when a message is received with a `start` routing key. The customer is buffered,
+        and added to the cache or has their last_active time updated when the buffer is drained.
+
+        :param headers: the customer's parsed message headers
+        """
+        self._buffer.append((START, headers))
 
     def on_stop(self, phone):
         """
-        When we receive a stop message, we need to remove the customer from the cache. Customer
-        records will only be deleted if they are not in cooldown. Records in cooldown are never
+        When we receive a stop message, we need to remove the customer from the cache. The stop
+        is buffered, and the customer is removed when the buffer is drained. Customer records
+        will only be deleted if they are not in cooldown. Records in cooldown are never
         included as part of a published manifest.
 
         :param phone: the phone number which identifies this customer
         """
-        with self.conn as conn:
-            deleted_records = dbapi.delete_record(conn, phone)
-            if deleted_records != 1:
-                self.logger.warning(f'Received stop for customer not in cache, phone={phone}')
-                return
+        self._buffer.append((STOP, phone))
 
-        self.logger.info(f'Deleted record for customer phone={phone}')
+    def drain(self):
+        """
+        Apply every buffered start and stop to the cache in a single transaction, and then
+        acknowledge the messages they came from.
+
+        Starts and stops are kept in the order they arrived, because a stop followed by a start
+        for the same customer should leave them in the cache, and the reverse should not. Each
+        run of consecutive starts or stops is applied with a single statement.
+        """
+        if self._buffer:
+            # every start in the drain is recorded with the same timestamp
+            now = time.time()
+            with dbapi.bulk_transaction(self.conn) as conn:
+                for routing_key, group in itertools.groupby(self._buffer, key=lambda b: b[0]):
+                    items = [item for _, item in group]
+                    if routing_key == START:
+                        dbapi.upsert_records_many(conn, items, now)
+                        for headers in items:
+                            self.logger.info(
+                                'Inserted or refreshed record for customer phone=%s',
+                                headers.phone)
+                        continue
+
+                    deleted = dbapi.delete_records_many(conn, items)
+                    for phone, count in zip(items, deleted):
+                        if count:
+                            self.logger.info('Deleted record for customer phone=%s', phone)
+                        else:
+                            self.logger.warning(
+                                'Received stop for customer not in cache, phone=%s', phone)
+            self._buffer.clear()
+
+        self.flush_acks()
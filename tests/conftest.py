@@ -1,12 +1,14 @@
 """ Pytest Fixtures and default data. """
 import uuid
-import time
 
 import faker
 import pytest
 
 import mpi.dbapi as dbapi
 
+# Building a Faker loads all of its providers, which is slow, so every test shares one.
+_fake = faker.Faker()
+
 @pytest.fixture(scope='function')
 def conn():
     """
@@ -25,12 +27,11 @@ def gen_headers():
     This mimics the headers containing customer metadata we would get from RabbitMQ when we
     receive a message.
     """
-    fake = faker.Faker()
     headers = {
-        "region": fake.city(),
-        "description": fake.company(),
-        "phone": fake.phone_number(),
-        "ip_address": fake.ipv4(),
+        "region": _fake.city(),
+        "description": _fake.company(),
+        "phone": _fake.phone_number(),
+        "ip_address": _fake.ipv4(),
         "guid": f"{uuid.uuid4()}"
     }
     return headers
@@ -40,30 +41,17 @@ def insert_records(conn, num=1):
     records = []
     for i in range(0, num):
         record = gen_headers()
-        record['date_created'] = time.time()
-        record['last_active'] = time.time()
-        records.append(record)
+        records.append((
+            record['phone'],
+            record['ip_address'],
+            record['region'],
+            record['guid'],
+            record['description']))
 
     with conn:
-        c = conn.executemany("""
-        INSERT INTO record (
-            phone,
-            ip_addr,
-            region,
-            guid,
-            date_created,
-            last_active,
-            description
-        ) VALUES (
-            :phone,
-            :ip_addr,
-            :region,
-            :guid,
-            :date_created,
-            :last_active,
-            :description
-        )""", records)
-        assert c.rowcount == num
+        # use the same batched insert as the service, with one timestamp for every record
+        count = dbapi.insert_records(conn, records)
+        assert count == num
 
 def count_records(conn):
     """ Count the total records in the cache. """
@@ -72,5 +60,5 @@ def count_records(conn):
             SELECT COUNT (phone)
             FROM record
         """)
-        # This is a bit weird because of the dict cursor
+        # This is a bit weird because rows are keyed by the column expression
         return c.fetchone()['COUNT (phone)']
@@ -3,6 +3,7 @@ These are more faux integration tests, than unit tests, but they are fairly cont
 because the cache is just SQLite in memory. They mainly exist to test areas of the code
 which rely on multiple queries being executed in sequence.
 """
+import time
 import logging
 
 from uuid import uuid4
@@ -10,6 +11,8 @@ from uuid import uuid4
 import mpi.service as svc
 import mpi.dbapi as dbapi
 
+from mpi.headers import Headers
+
 import tests.conftest as helpers
 
 def init_mpi(mocker):
@@ -35,17 +38,22 @@ def test_adding_and_removing_records(conn, mocker, caplog):
     # run the callback with our first start
     message.delivery_info = {'routing_key': 'start'}
     mpi.message_callback(message)
+    # messages are buffered until they are drained
+    assert helpers.count_records(conn) == 0
+    mpi.drain()
     assert helpers.count_records(conn) == 1
 
     # send an update for the same customer
     message.delivery_info = {'routing_key': 'start'}
     mpi.message_callback(message)
+    mpi.drain()
     # record should have been updated
     assert helpers.count_records(conn) == 1
 
     # record has not been published so should be cleanly pruned
     message.delivery_info = {'routing_key': 'stop'}
     mpi.message_callback(message)
+    mpi.drain()
     assert helpers.count_records(conn) == 0
 
     # log is generated if we try to stop the same customer, as they
@@ -53,9 +61,30 @@ def test_adding_and_removing_records(conn, mocker, caplog):
     message.delivery_info = {'routing_key': 'stop'}
     with caplog.at_level(logging.WARNING):
         mpi.message_callback(message)
-        assert 'not in cache' in caplog.text
+        mpi.drain()
+        assert f"not in cache, phone={message.application_headers['phone']}" in caplog.text
     assert helpers.count_records(conn) == 0
 
+def test_drain_keeps_message_order(conn, mocker):
+    """
+    Starts and stops drained together are applied in the order they arrived, so a customer
+    who stops and then starts again remains in the cache.
+    """
+    mpi = init_mpi(mocker)
+    mpi.conn = conn
+
+    mpi.on_start(Headers('1111', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard'))
+    mpi.on_start(Headers('2222', '8.8.8.8', 'diagon alley', f'{uuid4()}', 'witch'))
+    mpi.on_stop('1111')
+    mpi.on_stop('2222')
+    mpi.on_start(Headers('2222', '8.8.8.8', 'diagon alley', f'{uuid4()}', 'witch'))
+    mpi.drain()
+
+    assert helpers.count_records(conn) == 1
+    record = dbapi.select_record(conn, '2222')
+    assert record['region'] == 'diagon alley'
+    assert record['description'] == 'witch'
+
 def test_cache_prune(conn, mocker):
     """
     Test expired records and records which have completed cooldown are the only ones
@@ -69,5 +98,6 @@ def test_cache_prune(conn, mocker):
         dbapi.insert_record(cur, '2222', '8.8.8.8', 'diagon alley', f'{uuid4()}', 'witch')
     assert helpers.count_records(conn) == 2
     # force a prune. Nothing should happen because we are well within the expiry time
-    mpi._prune_cache()
+    with conn as cur:
+        mpi._prune_cache(cur, time.time())
     assert helpers.count_records(conn) == 2
@@ -0,0 +1,29 @@
+""" Tests parsing customer metadata from message headers. """
+import pytest
+
+import mpi.headers as hdrs
+
+import tests.conftest as helpers
+
+def test_parse():
+    """ Headers are parsed into fields in the order the cache inserts them. """
+    headers = helpers.gen_headers()
+    parsed = hdrs.parse(headers)
+    assert parsed == (
+        headers['phone'],
+        headers['ip_address'],
+        headers['region'],
+        headers['guid'],
+        headers['description'])
+    assert parsed.ip_addr == headers['ip_address']
+
+    # an empty description is replaced, rather than stored
+    headers['description'] = ''
+    assert hdrs.parse(headers).description == 'UNKNOWN'
+
+def test_parse_error():
+    """ Missing headers raise a HeaderError naming the missing key. """
+    headers = helpers.gen_headers()
+    del headers['guid']
+    with pytest.raises(hdrs.HeaderError, match="KeyError: 'guid'"):
+        hdrs.parse(headers)
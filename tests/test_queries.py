@@ -1,4 +1,5 @@
 """ Test the SQLite queries return the expected data. """
+import time
 import pytest
 import sqlite3
 
@@ -19,6 +20,15 @@ def test_duplicate_customer(conn):
         with pytest.raises(sqlite3.IntegrityError, match="UNIQUE constraint"):
             dbapi.insert_record(cur, '1234', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard')
 
+        # the batched insert fails the same way, whether the duplicate is already in the
+        # cache or within the batch itself
+        with pytest.raises(sqlite3.IntegrityError, match="UNIQUE constraint"):
+            dbapi.insert_records(cur, [('1234', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard')])
+        with pytest.raises(sqlite3.IntegrityError, match="UNIQUE constraint"):
+            dbapi.insert_records(cur, [
+                ('5678', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard'),
+                ('5678', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard')])
+
 def test_delete_record(conn):
     """
     Test deleting records that do and don't exist. The delete record method
@@ -33,13 +43,54 @@ def test_delete_record(conn):
         count = dbapi.delete_record(cur, '1234')
         assert count == 1
 
+        # records inserted as a batch are deleted the same way
+        dbapi.insert_records(cur, [
+            ('1111', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard'),
+            ('2222', '127.0.0.1', 'azkaban', f'{uuid4()}', 'witch')])
+        assert dbapi.delete_record(cur, '1111') == 1
+        assert dbapi.delete_record(cur, '2222') == 1
+
+def test_bulk_transaction(conn):
+    """ Everything in the block commits together, or is rolled back together on an error. """
+    with dbapi.bulk_transaction(conn) as cur:
+        dbapi.insert_record(cur, '1111', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard')
+        dbapi.insert_record(cur, '2222', '127.0.0.1', 'azkaban', f'{uuid4()}', 'witch')
+    assert not conn.in_transaction
+    assert helpers.count_records(conn) == 2
+
+    with pytest.raises(sqlite3.IntegrityError):
+        with dbapi.bulk_transaction(conn) as cur:
+            dbapi.insert_record(cur, '3333', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard')
+            dbapi.insert_record(cur, '1111', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard')
+    assert not conn.in_transaction
+    assert dbapi.select_record(conn, '3333') is None
+
+    # if the transaction has already ended, the original error is raised
+    with pytest.raises(RuntimeError):
+        with dbapi.bulk_transaction(conn) as cur:
+            cur.execute("ROLLBACK")
+            raise RuntimeError
+    assert not conn.in_transaction
+
+def test_insert_records_chunking(conn):
+    """ Batches bigger than SQLite's parameter limit are split across several statements. """
+    num = dbapi._VALUES_CHUNK_SIZE * 2 + 1
+    records = [(f'{i}', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard') for i in range(num)]
+    with conn as cur:
+        assert dbapi.insert_records(cur, records) == num
+        assert helpers.count_records(cur) == num
+
+    # each batch size is only ever built once
+    sql = dbapi._values_sql(dbapi._SQL_INSERT_RECORDS, 1)
+    assert dbapi._values_sql(dbapi._SQL_INSERT_RECORDS, 1) is sql
+
 def test_get_record(conn):
     """ Test getting records that do and don't exist. """
     with conn as cur:
         dbapi.insert_record(cur, '1234', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard')
-        # record is returned as a dictionary with expected keys
+        # record is returned as a row with the expected keys
         out = dbapi.select_record(cur, '1234')
-        assert {'phone', 'ip_addr', 'cooldown_expiry', 'tasked_time', 'region'} <= out.keys()
+        assert {'phone', 'ip_addr', 'cooldown_expiry', 'tasked_time', 'region'} <= set(out.keys())
 
         # a record that doesn't exist returns None
         out = dbapi.select_record(cur, '7890')
@@ -50,30 +101,96 @@ def test_record_ordering(conn):
     Its important that the records are returned in the correct order, as we may trim
     the manifest if the cache is oversized.
     """
+    # give each record its own timestamp, rather than relying on the clock moving between inserts
+    now = time.time()
     with conn as cur:
-        dbapi.insert_record(cur, '1111', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard')
-        dbapi.insert_record(cur, '2222', '127.0.0.1', 'diagon alley', f'{uuid4()}', 'wizard')
-        dbapi.insert_record(cur, '3333', '127.0.0.1', 'azkaban', f'{uuid4()}', 'wizard')
-        records = dbapi.select_manifest_records(cur, 60)
+        dbapi.insert_record(cur, '1111', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard', now - 2)
+        dbapi.insert_record(
+            cur, '2222', '127.0.0.1', 'diagon alley', f'{uuid4()}', 'wizard', now - 1)
+        dbapi.insert_record(cur, '3333', '127.0.0.1', 'azkaban', f'{uuid4()}', 'wizard', now)
+        records = dbapi.select_manifest_records(cur, 60).fetchall()
         assert records[0]['phone'] == '3333'
         assert records[1]['phone'] == '2222'
         assert records[2]['phone'] == '1111'
 
+        # the limit keeps the newest records
+        records = dbapi.select_manifest_records(cur, 60, limit=2).fetchall()
+        assert [r['phone'] for r in records] == ['3333', '2222']
+
+def test_task_manifest_columns(conn):
+    """ The newest eligible records are returned, with the same columns as a select, and tasked. """
+    now = time.time()
+    with conn as cur:
+        dbapi.insert_record(cur, '1111', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard', now - 2)
+        dbapi.insert_record(
+            cur, '2222', '127.0.0.1', 'diagon alley', f'{uuid4()}', 'wizard', now - 1)
+        dbapi.insert_record(cur, '3333', '127.0.0.1', 'azkaban', f'{uuid4()}', 'wizard', now)
+        rows = [dict(r) for r in dbapi.select_manifest_records(cur, 60, limit=2)]
+
+        columns = dbapi.task_manifest_columns(cur, 60, limit=2, now=now)
+        assert tuple(columns) == dbapi.MANIFEST_COLUMNS
+        # newest first, with the tasked_time they had before
+        assert [dict(zip(columns, row)) for row in zip(*columns.values())] == rows
+        assert columns['tasked_time'] == (None, None)
+
+        # only the returned records were tasked
+        assert dbapi.select_record(cur, '1111')['tasked_time'] is None
+        assert dbapi.select_record(cur, '2222')['tasked_time'] == now
+        assert dbapi.select_record(cur, '3333')['tasked_time'] == now
+
+        # an empty selection still has every column
+        columns = dbapi.task_manifest_columns(cur, -60)
+        assert columns == {name: () for name in dbapi.MANIFEST_COLUMNS}
+
+def test_task_manifest_ties(conn):
+    """ When the limit splits records created together, only the returned ones are tasked. """
+    records = [(f'{i}', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard') for i in range(10)]
+    with conn as cur:
+        dbapi.insert_records(cur, records)
+        columns = dbapi.task_manifest_columns(cur, 60, limit=4)
+        tasked = cur.execute('SELECT phone FROM record WHERE tasked_time IS NOT NULL')
+        assert sorted(r['phone'] for r in tasked) == sorted(columns['phone'])
+
+def test_manifest_query_plan(conn):
+    """
+    The manifest is read from the index in date_created order, so SQLite never has to sort
+    the eligible records, and can stop as soon as the manifest is full.
+    """
+    plan = [row['detail'] for row in conn.execute(
+        f'EXPLAIN QUERY PLAN {dbapi._SQL_SELECT_MANIFEST_RECORDS}',
+        {'now': time.time(), 'active_time': 60, 'limit': 5})]
+    assert any('USING INDEX idx_cooldown' in detail for detail in plan)
+    assert not any('TEMP B-TREE' in detail for detail in plan)
+
+def test_count_manifest_records(conn):
+    """ Only records which are active and not in cooldown are counted. """
+    with conn as cur:
+        dbapi.insert_record(cur, '1111', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard')
+        dbapi.insert_record(cur, '2222', '127.0.0.1', 'diagon alley', f'{uuid4()}', 'wizard')
+        dbapi.insert_record(cur, '3333', '127.0.0.1', 'azkaban', f'{uuid4()}', 'wizard')
+        assert dbapi.count_manifest_records(cur, 60) == 3
+
+        cur.execute("UPDATE record SET cooldown_expiry = 1 WHERE phone = '3333'")
+        assert dbapi.count_manifest_records(cur, 60) == 2
+        # nothing is active if the active window has already passed
+        assert dbapi.count_manifest_records(cur, -60) == 0
+
 def test_marking_as_tasked(conn):
     """ Test records being marked as tasked. """
+    now = time.time()
     with conn as cur:
-        dbapi.insert_record(cur, '1111', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard')
-        dbapi.insert_record(cur, '2222', '192.168.1.1', 'azkaban', f'{uuid4()}', 'wizard')
+        dbapi.insert_record(cur, '1111', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard', now - 1)
+        dbapi.insert_record(cur, '2222', '192.168.1.1', 'azkaban', f'{uuid4()}', 'wizard', now)
         assert helpers.count_records(cur) == 2
 
-        # Update only the record 1111 to tasked
-        dbapi.update_to_tasked(cur, [{'phone': '1111'}])
+        # Task only the newest record, 2222
+        dbapi.task_manifest_columns(cur, 60, limit=1, now=now)
         records = cur.execute('SELECT phone, tasked_time FROM record;').fetchall()
         for r in records:
             if r['phone'] == '1111':
-                assert r['tasked_time'] is not None
-            if r['phone'] == '2222':
                 assert r['tasked_time'] is None
+            if r['phone'] == '2222':
+                assert r['tasked_time'] is not None
 
 def test_delete_expired(conn):
     """
@@ -93,3 +210,28 @@ def test_delete_expired(conn):
         assert removed_count == 0
         assert helpers.count_records(conn) == 1
 
+
+def test_upsert_records(conn):
+    """
+    New customers in a batch are inserted, and customers already in the cache only have
+    their last_active time refreshed.
+    """
+    with conn as cur:
+        dbapi.insert_record(cur, '1111', '127.0.0.1', 'hogwarts', f'{uuid4()}', 'wizard')
+        before = dbapi.select_record(cur, '1111')
+
+        count = dbapi.upsert_records_many(cur, [
+            ('1111', '127.0.0.1', 'azkaban', f'{uuid4()}', 'wizard'),
+            ('2222', '192.168.1.1', 'azkaban', f'{uuid4()}', 'witch')])
+        assert count == 2
+        assert helpers.count_records(cur) == 2
+
+        after = dbapi.select_record(cur, '1111')
+        assert after['region'] == 'hogwarts'
+        assert after['date_created'] == before['date_created']
+        assert after['last_active'] > before['last_active']
+
+        # deleting in bulk reports what was removed for each phone, so a repeated stop misses
+        deleted = dbapi.delete_records_many(cur, ['1111', '2222', '7890', '1111'])
+        assert deleted == [1, 1, 0, 0]
+        assert helpers.count_records(cur) == 0
@@ -1,6 +1,11 @@
 """ Tests the MPI service class. """
+import time
 import pytest
+import sqlite3
 import mpi.service as svc
+import mpi.dbapi as dbapi
+
+from mpi.headers import Headers
 
 import tests.conftest as helpers
 
@@ -12,7 +17,7 @@ def test_message_callback(mocker):
     pi = mocker.Mock()
     message.delivery_info = {'routing_key': 'bad'}
     svc.Pi.message_callback(pi, message)
-    assert pi.rabbit.reject_message.called
+    assert pi._reject.called
     assert not pi.on_start.called
     assert not pi.on_stop.called
 
@@ -22,7 +27,7 @@ def test_message_callback(mocker):
     svc.Pi.message_callback(pi, message)
     assert pi.on_start.called
     assert not pi.on_stop.called
-    assert not pi.rabbit.reject_message.called
+    assert not pi._reject.called
 
     pi = mocker.Mock()
     message.delivery_info = {'routing_key': 'stop'}
@@ -30,7 +35,46 @@ def test_message_callback(mocker):
     svc.Pi.message_callback(pi, message)
     assert pi.on_stop.called
     assert not pi.on_start.called
-    assert not pi.rabbit.reject_message.called
+    assert not pi._reject.called
+
+def test_stop(mocker):
+    """ Connections are closed when stopping, even if the final drain fails. """
+    pi = mocker.Mock()
+    pi.drain.side_effect = sqlite3.OperationalError
+    with pytest.raises(sqlite3.OperationalError):
+        svc.Pi.stop(pi)
+    assert pi.rabbit.stop.called
+    assert pi.conn.close.called
+
+def test_flush_acks(mocker):
+    """ Pending messages are acknowledged together, using the most recent delivery tag. """
+    pi = mocker.Mock()
+    pi._pending_tags = [1, 2, 3]
+    svc.Pi.flush_acks(pi)
+    pi.rabbit.consume_channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+    assert pi._pending_tags == []
+
+    # nothing is acknowledged if there is nothing pending
+    svc.Pi.flush_acks(pi)
+    assert pi.rabbit.consume_channel.basic_ack.call_count == 1
+
+def test_batching(mocker):
+    """ Messages are only drained and acknowledged once a full batch has been received. """
+    pi = mocker.Mock()
+    pi._pending_tags = []
+    pi.batch_size = svc.BATCH_SIZE
+    pi._maybe_drain.side_effect = lambda: svc.Pi._maybe_drain(pi)
+    message = mocker.Mock()
+    message.delivery_info = {'routing_key': 'start'}
+    message.application_headers = helpers.gen_headers()
+    for tag in range(1, svc.BATCH_SIZE):
+        message.delivery_tag = tag
+        svc.Pi.message_callback(pi, message)
+    assert not pi.drain.called
+
+    message.delivery_tag = svc.BATCH_SIZE
+    svc.Pi.message_callback(pi, message)
+    assert pi.drain.called
 
 def test_callback_error(mocker):
     """
@@ -44,7 +88,7 @@ def test_callback_error(mocker):
     mocker.patch('mpi.dbapi.create_cache')
     pi.rabbit.consume.return_value = svc.Pi.message_callback(pi, message)
     svc.Pi.run(pi)
-    assert pi.rabbit.reject_message.called
+    assert pi._reject.called
     assert not pi.on_start.called
     assert not pi.on_stop.called
 
@@ -65,16 +109,26 @@ def test_send_to_cooldown(mocker):
     pi.manifest_size = 5
 
     mock_cooldown = mocker.patch('mpi.dbapi.update_to_cooldown')
-    mock_free = mocker.patch('mpi.dbapi.update_free_cooldown')
-    # return a list of 10 items on the first call to this mock, and 2 items the second call
-    # this allows us to simulate a database call which retrieves all the records
-    mock_select = mocker.patch('mpi.dbapi.select_manifest_records', side_effect=[
-        ["a"]*10, ["a"]*2])
-
-    svc.Pi._send_to_cooldown(pi)
-    assert mock_select.call_count == 2
+    mock_free = mocker.patch('mpi.dbapi.update_free_cooldown', return_value=1)
+    # return a count of 10 on the first call to this mock, and 2 on the second call
+    # this allows us to simulate a database call which counts all the records
+    mock_count = mocker.patch('mpi.dbapi.count_manifest_records', side_effect=[10, 2])
+
+    eligible_count = svc.Pi._send_to_cooldown(pi, pi.conn, time.time())
+    assert mock_count.call_count == 2
     assert mock_cooldown.called
     assert mock_free.called
+    # the freed customer is added to the recount
+    assert eligible_count == 3
+
+    # if the cache isn't oversized, nothing is sent to cooldown and it is only counted once
+    mock_count.reset_mock()
+    mock_cooldown.reset_mock()
+    mock_count.side_effect = [4]
+    eligible_count = svc.Pi._send_to_cooldown(pi, pi.conn, time.time())
+    assert mock_count.call_count == 1
+    assert not mock_cooldown.called
+    assert eligible_count == 5
 
 def test_generate_manifest(mocker):
     """
@@ -83,29 +137,65 @@ def test_generate_manifest(mocker):
     pi = mocker.Mock()
     pi.conn = mocker.MagicMock()
     pi.manifest_size = 2
-    mocker.patch('mpi.dbapi.select_manifest_records', return_value=["a"]*5)
-    mock_update = mocker.patch('mpi.dbapi.update_to_tasked')
+    pi._send_to_cooldown.return_value = 5
+    mock_task = mocker.patch(
+        'mpi.dbapi.task_manifest_columns', return_value={'phone': ('1111', '2222')})
 
     manifest = svc.Pi.generate_manifest(pi)
     assert pi._prune_cache.called
     assert pi._send_to_cooldown.called
-    assert mock_update.called
-    assert len(manifest) == 2
+    assert mock_task.call_args.kwargs['limit'] == 2
+    # every step is judged against the same moment
+    now = mock_task.call_args.kwargs['now']
+    assert pi._prune_cache.call_args.args[1] == now
+    assert pi._send_to_cooldown.call_args.args[1] == now
+    assert len(manifest['phone']) == 2
+
+def test_pack_record():
+    """ The generated packer builds the same record as zipping the column names. """
+    names = ('phone', 'region', 'last_active')
+    pack = svc._make_packer(names)
+    assert pack('1111', 'hogwarts', 1.5) == dict(zip(names, ('1111', 'hogwarts', 1.5)))
+    assert svc._pack_record(*dbapi.MANIFEST_COLUMNS) == {
+        name: name for name in dbapi.MANIFEST_COLUMNS}
 
 def test_on_start(mocker):
-    """ Test customers are either added or updated, not both. """
+    """ Test starts and stops are buffered, and don't touch the cache until drained. """
     pi = mocker.Mock()
     pi.conn = mocker.MagicMock()
-    mocker.patch('mpi.dbapi.select_record', side_effect=[None, 1])
-
-    mock_insert = mocker.patch('mpi.dbapi.insert_record')
-    mock_update = mocker.patch('mpi.dbapi.update_active_time')
-    svc.Pi.on_start(pi, '1111', '127.0.0.1', 'hogwarts', 'wizard', '111-111')
-    assert mock_insert.called
-    assert not mock_update.called
-
-    mock_insert = mocker.patch('mpi.dbapi.insert_record')
-    mock_update = mocker.patch('mpi.dbapi.update_active_time')
-    svc.Pi.on_start(pi, '1111', '127.0.0.1', 'hogwarts', 'wizard', '111-111')
-    assert mock_update.called
-    assert not mock_insert.called
\ No newline at end of file
+    pi._buffer = []
+    mock_upsert = mocker.patch('mpi.dbapi.upsert_records_many')
+    mock_delete = mocker.patch('mpi.dbapi.delete_records_many')
+
+    headers = Headers('1111', '127.0.0.1', 'hogwarts', '111-111', 'wizard')
+    svc.Pi.on_start(pi, headers)
+    svc.Pi.on_stop(pi, '1111')
+    assert pi._buffer == [(svc.START, headers), (svc.STOP, '1111')]
+    assert not mock_upsert.called
+    assert not mock_delete.called
+
+def test_drain(mocker):
+    """ Test consecutive starts and stops are applied together, then acknowledged. """
+    pi = mocker.Mock()
+    pi.conn = mocker.MagicMock()
+    first = Headers('1111', '127.0.0.1', 'hogwarts', '111-111', 'wizard')
+    second = Headers('2222', '127.0.0.1', 'azkaban', '222-222', 'witch')
+    pi._buffer = [
+        (svc.START, first), (svc.START, second), (svc.STOP, '1111'), (svc.STOP, '1111'),
+        (svc.START, first)]
+    mock_upsert = mocker.patch('mpi.dbapi.upsert_records_many')
+    mock_delete = mocker.patch('mpi.dbapi.delete_records_many', return_value=[1, 0])
+
+    svc.Pi.drain(pi)
+    assert mock_upsert.call_count == 2
+    assert mock_upsert.call_args_list[0].args[1] == [first, second]
+    # both runs of starts in the drain share a timestamp
+    first, second = mock_upsert.call_args_list
+    assert first.args[2] == second.args[2]
+    mock_delete.assert_called_once()
+    # each stop is logged by its own result, so a repeated stop is only missed the second time
+    pi.logger.info.assert_any_call('Deleted record for customer phone=%s', '1111')
+    pi.logger.warning.assert_called_once_with(
+        'Received stop for customer not in cache, phone=%s', '1111')
+    assert pi._buffer == []
+    assert pi.flush_acks.called
\ No newline at end of file
@@ -1,17 +1,27 @@
 """ Tests the timer functionality of mrabbit. """
-import datetime
+import socket
+import itertools
+
+import pytest
 
 import mpi.rabbit as rabbit
 
+def init_rabbit(mocker):
+    """ A mock rabbit instance with empty timer tracking. """
+    r = mocker.Mock()
+    r.timers = {}
+    r._heap = []
+    r._sequence = itertools.count()
+    return r
+
 def test_add_timer(mocker):
     """
     Test adding, and re-adding a timer to a rabbit instance.
     """
-    r = mocker.Mock()
-    r.timers = {}
+    r = init_rabbit(mocker)
     rabbit.Rabbit.add_timer(r, 'mytimer', 10, print)
     timer = r.timers['mytimer']
-    assert timer.interval == datetime.timedelta(seconds=10)
+    assert timer.interval == 10
     assert timer.method == print
 
     # adding the timer again with updated values causes it to be replaced
@@ -19,18 +29,72 @@ def test_add_timer(mocker):
     rabbit.Rabbit.add_timer(r, 'mytimer', 20, my_method)
     assert len(r.timers) == 1
     timer = r.timers['mytimer']
-    assert timer.interval == datetime.timedelta(seconds=20)
+    assert timer.interval == 20
     assert timer.method == my_method
 
 def test_check_timers(mocker):
     """ Test run the timers. """
     my_method = mocker.Mock()
-    r = mocker.Mock()
-    r.timers = {}
+    r = init_rabbit(mocker)
     rabbit.Rabbit.add_timer(r, 'mytimer', 0, my_method)
     rabbit.Rabbit.check_timers(r)
     assert my_method.called
 
+def test_timer_heap(mocker):
+    """
+    Timers are kept in a heap ordered by due time. Only the due timers at the head of the heap
+    are run, and entries for replaced or deleted timers are dropped rather than run.
+    """
+    def assert_heap(heap):
+        keys = [entry[:2] for entry in heap]
+        for i in range(1, len(keys)):
+            assert keys[(i - 1) // 2] <= keys[i]
+
+    r = init_rabbit(mocker)
+    methods = {name: mocker.Mock() for name in ('soon', 'replaced', 'deleted', 'later')}
+    rabbit.Rabbit.add_timer(r, 'later', 60, methods['later'])
+    rabbit.Rabbit.add_timer(r, 'soon', 0, methods['soon'])
+    rabbit.Rabbit.add_timer(r, 'replaced', 0, methods['replaced'])
+    rabbit.Rabbit.add_timer(r, 'deleted', 0, methods['deleted'])
+    assert_heap(r._heap)
+    assert r._heap[0][2].name == 'soon'
+
+    replacement = mocker.Mock()
+    rabbit.Rabbit.add_timer(r, 'replaced', 0, replacement)
+    rabbit.Rabbit.delete_timer(r, 'deleted')
+    assert_heap(r._heap)
+
+    rabbit.Rabbit.check_timers(r)
+    assert methods['soon'].call_count == 1
+    assert replacement.call_count == 1
+    assert not methods['replaced'].called
+    assert not methods['deleted'].called
+    assert not methods['later'].called
+
+    # the stale entries are gone, and every live timer has exactly one entry
+    assert_heap(r._heap)
+    assert sorted(entry[2].name for entry in r._heap) == ['later', 'replaced', 'soon']
+    assert all(r.timers[entry[2].name] is entry[2] for entry in r._heap)
+
+def test_busy_queue_runs_timers(mocker):
+    """ Timers still run when there is always another message waiting to be drained. """
+    class Stop(Exception):
+        """ Raised by the timer to end the consume loop. """
+
+    r = rabbit.Rabbit('localhost', 'guest', 'guest', {'input_queue': 'pi'})
+    readable, writer = socket.socketpair()
+    with readable, writer:
+        # the socket always has something to read, and draining never times out
+        writer.send(b'x')
+        r.conn = mocker.Mock(sock=readable)
+        r.consume_channel = mocker.Mock()
+
+        r.add_timer('manifest', 0.01, mocker.Mock(side_effect=Stop))
+        with pytest.raises(Stop):
+            r.consume(mocker.Mock())
+    # reads wait briefly for the rest of a split frame, rather than spinning
+    r.conn.drain_events.assert_called_with(rabbit.DRAIN_TIMEOUT)
+
 def test_delete_timer(mocker):
     """ Testing handling deletion and cleanup of timers. """
     r = mocker.Mock()
@@ -38,4 +102,5 @@ def test_delete_timer(mocker):
         'mytimer': mocker.Mock(),
         'myothertimer': mocker.Mock()}
     rabbit.Rabbit.delete_timer(r, 'mytimer')
-    rabbit.Rabbit.delete_timer(r, 'nonexistent')
\ No newline at end of file
+    rabbit.Rabbit.delete_timer(r, 'nonexistent')
+    assert list(r.timers) == ['myothertimer']
\ No newline at end of file